@@ -25,11 +25,17 @@
 # Mar 2016
 #
 
+import os
 from sys import argv
 from sys import exit as sysexit
-from os import linesep as linesep_str
-from os.path import exists
-from tempfile import mkstemp
+from sys import exc_info as sys_exc_info
+from os import listdir, remove, rmdir
+from os.path import exists, splitext, dirname, abspath, join
+from select import select
+from time import sleep, time
+from threading import Timer
+from random import Random
+from tempfile import mkstemp, mkdtemp
 from subprocess import check_output
 from decimal import Decimal
 from base64 import b64decode
@@ -45,52 +51,109 @@ def bs(x):
         return x.encode("utf-8")
     return x
 
-NL = bs(linesep_str)
+# Lines are split on \n on all platforms. A \r before the \n is kept as
+# part of the line ending, and new lines get the line ending of the file.
+NL = bs("\n")
+CR = bs("\r")
+CRLF = bs("\r\n")
 ASSIGNMENTS = [bs('=='), bs('=>'), bs('+='), bs('-='), bs('?='),
                bs('='), bs(':='), bs('::'), bs(':')]
+# The += and -= operators are skipped when finding keys and values
+KEY_ASSIGNMENTS = [ass for ass in ASSIGNMENTS if ass not in [bs('+='), bs('-=')]]
+COMMENTS = (bs("#"), bs("//"), bs("/*"))
+# The largest number of buffers that can be given to writev at once
+IOV_MAX = 1024
+# How much of the end of a file to read before appending a line to it
+TAIL_SIZE = 4096
+
+
+def view(data):
+    """Return a memoryview of the data, so that slices of it are not copies.
+    On Python 2, slices of a memoryview can not be joined or written like
+    byte strings, so the data is returned as it is."""
+    if type(b"") == type(""):
+        return data
+    return memoryview(data)
+
+
+def write_segments(f, segments):
+    """Write a list of byte strings and memoryviews to an open file,
+    without joining them first. Uses writev, where available."""
+    if not hasattr(os, "writev"):
+        for segment in segments:
+            f.write(segment)
+        return
+    f.flush()
+    fd = f.fileno()
+    segments = [segment for segment in segments if len(segment)]
+    i = 0
+    while i < len(segments):
+        written = os.writev(fd, segments[i:i + IOV_MAX])
+        # Skip past what was written, the last write may have been partial
+        while written and written >= len(segments[i]):
+            written -= len(segments[i])
+            i += 1
+        if written:
+            segments[i] = view(segments[i])[written:]
+
+
+def detect_newline(data):
+    """Return the line ending that most lines in the data end with,
+    \r\n or \n. Data without line endings uses \n."""
+    crlf = data.count(CRLF)
+    if crlf and crlf * 2 > data.count(NL):
+        return CRLF
+    return NL
+
+
+def key_lines(data, key):
+    """Yield the start and end position of each line that contains the key.
+    The end is before the line ending, which can be \n or \r\n.
+    The data is searched for the key, so other lines are skipped quickly."""
+    length = len(data)
+    pos = data.find(key)
+    while pos != -1:
+        start = data.rfind(NL, 0, pos) + 1
+        end = data.find(NL, pos)
+        if end == -1:
+            end = length
+        nextpos = end + 1
+        if end > start and data[end - 1:end] == CR:
+            end -= 1
+        yield start, end
+        pos = data.find(key, nextpos)
+
+
+def find_assignment(line):
+    """Return the position and the assignment that comes first in the line,
+    or -1 and an empty byte string. Lines that are blank or start with
+    #, // or /* have no assignment."""
+    stripline = line.strip()
+    if not stripline or stripline.startswith(COMMENTS):
+        return -1, bs("")
+    # If several assignments are found, use the first one.
+    # For assignments at the same position, the order in ASSIGNMENTS is used.
+    firstpos = -1
+    assignment = bs("")
+    for ass in KEY_ASSIGNMENTS:
+        pos = line.find(ass)
+        if pos != -1 and (firstpos == -1 or pos < firstpos):
+            firstpos = pos
+            assignment = ass
+    return firstpos, assignment
 
 
 def parts(line, including_assignment=True):
     """Return the key and value parts of a line, if there is an assignment there.
     May include the assignment as part of the key."""
-    stripline = line.strip()
-    if not stripline:
-        return None, None
-    # Skip lines that start with #, // or /*
-    for commentsymbol in [bs("#"), bs("//"), bs("/*")]:
-        if stripline.startswith(commentsymbol):
-            # Skip this line
-            return None, None
-    # These assignments are supported, in this order
-    assignment = bs("")
-    found = []
-    for ass in ASSIGNMENTS:
-        # Skip the += and -= operators when finding keys and values
-        if ass in [bs('+='), bs('-=')]:
-            continue
-        # Collect the rest
-        if ass in line:
-            found.append(ass)
-    if len(found) == 1:
-        # Only one assignment were found
-        assignment = found[0]
-    elif found:  # > 1
-        # If several assignments are found, use the first one
-        firstpos = len(line)
-        firstassignment = bs("")
-        for ass in found:
-            pos = line.index(ass)
-            if pos < firstpos:
-                firstpos = pos
-                firstassignment = ass
-        assignment = firstassignment
+    pos, assignment = find_assignment(line)
     # Return the "key" part of the line
     if assignment:
-        fields = line.split(assignment, 1)
+        valuepos = pos + len(assignment)
         if including_assignment:
-            return fields[0] + assignment, fields[1]
+            return line[:valuepos], line[valuepos:]
         else:
-            return fields[0], fields[1]
+            return line[:pos], line[valuepos:]
     # No assignments were found
     return None, None
 
@@ -103,22 +166,37 @@ def secondpart(line, including_assignment=True):
     return parts(line, including_assignment)[1]
 
 
+def joinvalue(line, first, newvalue):
+    """Return the first part of the line and the new value, with a space or
+    a tab in between if the line has one after an assignment."""
+    if bs("= ") in line or bs(": ") in line or bs("> ") in line:
+        return first + bs(" ") + newvalue
+    elif bs("=\t") in line or bs(":\t") in line or bs(">\t") in line:
+        return first + bs("\t") + newvalue
+    else:
+        return first + newvalue
+
+
 def changeline(line, newvalue):
     line = bs(line)
     newvalue = bs(newvalue)
 
     first = firstpart(line)
     if first:
-        if bs("= ") in line or bs(": ") in line or bs("> ") in line:
-            return first + bs(" ") + newvalue
-        elif bs("=\t") in line or bs(":\t") in line or bs(">\t") in line:
-            return first + bs("\t") + newvalue
-        else:
-            return first + newvalue
+        return joinvalue(line, first, newvalue)
     else:
         return line
 
 
+def changekeyline(line, key, value):
+    """Return the line with the new value if the line assigns to the given key,
+    otherwise None. The line, key and value must be bytes."""
+    pos, assignment = find_assignment(line)
+    if not pos or not assignment or line[:pos].strip() != key:
+        return None
+    return joinvalue(line, line[:pos + len(assignment)], value)
+
+
 def test_changeline():
     passes = True
     passes = passes and changeline(" // ost = 2", "3") == bs(" // ost = 2")
@@ -152,20 +230,55 @@ def change(lines, key, value):
 
     newlines = []
     for line in lines:
-        if not line.strip():
+        newline = changekeyline(line, key, value)
+        if newline is None:
             newlines.append(line)
-            continue
-        firstp = firstpart(line, False)
-        if not firstp:
-            newlines.append(line)
-            continue
-        elif firstp.strip() == key:
-            newlines.append(changeline(line, value))
         else:
-            newlines.append(line)
+            newlines.append(newline)
     return newlines
 
 
+def to_segments(data, replacements):
+    """Return the data with the replacements made, as a list of segments,
+    where the unchanged parts are slices of a memoryview of the data.
+    replacements is a list of (start, end, bytes), sorted by start.
+    A replacement that overlaps an earlier one is skipped.
+    The list is empty if there are no replacements."""
+    if not replacements:
+        return []
+    data_view = view(data)
+    segments = []
+    copied = 0
+    for start, end, text in replacements:
+        if start < copied:
+            continue
+        segments.append(data_view[copied:start])
+        segments.append(text)
+        copied = end
+    segments.append(data_view[copied:])
+    return segments
+
+
+def line_replacements(data, key, value):
+    """Return a (start, end, new line) replacement for each line in the data
+    that assigns to the given key and does not have the value.
+    Only the lines that contain the key are looked at."""
+    replacements = []
+    for linestart, lineend in key_lines(data, key):
+        line = data[linestart:lineend]
+        newline = changekeyline(line, key, value)
+        if newline is not None and newline != line:
+            replacements.append((linestart, lineend, newline))
+    return replacements
+
+
+def change_segments(data, key, value):
+    """Change the lines in the data that assign to the given key, like change.
+    Returns the new data as a list of segments, see to_segments.
+    The list is empty if nothing would be changed."""
+    return to_segments(data, line_replacements(data, key, value))
+
+
 def test_change():
     testcontent = bs("""LIGHTS =    ON
 bananas= not present
@@ -189,8 +302,9 @@ tea := yes
     return passes
 
 
-def changefile(filename, key, value, dummyrun=False):
-    """if dummyrun==True, don't write but return True if changes would have been made"""
+def changefile(filename, key, value, dummyrun=False, fmt="plain"):
+    """if dummyrun==True, don't write but return True if changes would have been made.
+    fmt is the name of a format backend, or "plain"."""
 
     key = bs(key)
     value = bs(value)
@@ -199,54 +313,137 @@ def changefile(filename, key, value, dummyrun=False):
     try:
         with open(filename, 'rb') as f:
             data = f.read()
-            lines = data.split(NL)[:-1]
     except IOError:
         print("Can't read %s" % (filename))
         sysexit(2)
-    final_nl = True
-    if NL not in data:
-        lines = [data]
-        final_nl = False
-    elif not data.endswith(NL):
-        final_nl = False
-    # Change and write the file
-    changed_contents = NL.join(change(lines, key, value))
-    # Only add a final newline if the original contents had one at the end
-    if final_nl:
-        changed_contents += NL
+    segments = changed_segments(data, key, value, fmt)
     if dummyrun:
-        return data != changed_contents
+        return bool(segments)
+    if not segments:
+        # Nothing to change
+        return
+    # Write the file
     try:
         with open(filename, 'wb') as f:
-            f.write(changed_contents)
+            write_segments(f, segments)
     except IOError:
         print("No write permission: %s" % (filename))
         sysexit(2)
 
 
 def addtofile(filename, line):
-    """Tries to add a line to a file. UTF-8. No questions asked."""
+    """Tries to add a line to a file. UTF-8. No questions asked.
+    Only the end of the file is read, to find the line ending to use and
+    if a newline is needed first. The line is then appended to the file."""
 
     line = bs(line)
 
+    # Read the end of the file
+    try:
+        with open(filename, 'rb') as f:
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(max(0, size - TAIL_SIZE))
+            tail = f.read()
+    except IOError:
+        print("Can't read %s" % (filename))
+        sysexit(2)
+    newline = detect_newline(tail)
+    mode = 'ab'
+    if len(tail) == size and tail.strip() == bs(""):
+        # Replace a file that only has whitespace
+        mode = 'wb'
+        tail = bs("")
+    if tail and not tail.endswith(NL):
+        line = newline + line
+    # Add the line to the file
+    try:
+        with open(filename, mode) as f:
+            f.write(line + newline)
+    except IOError:
+        print("No write permission: %s" % (filename))
+        sysexit(2)
+
+
+def assigns(data, key):
+    """Check if a line in the data assigns to the key, with any whitespace
+    around the key. The key must be bytes."""
+    for start, end in key_lines(data, key):
+        if changekeyline(data[start:end], key, bs("")) is not None:
+            return True
+    return False
+
+
+def plan_edits(data, edits, fmt="plain"):
+    """Find what to change in the data, for a list of (key, value, keyvalue)
+    edits. Keys that are found get the value. Keys that are missing are
+    added, where keyvalue is the line to add for the plain format.
+    The format backend indexes the data once, for all the edits.
+    Returns a list of (start, end, bytes) replacements, sorted by start,
+    and a list of lines to add at the end of the data."""
+    index, blocks = {}, None
+    if fmt != "plain":
+        index, blocks = FORMATS[fmt][0](data)
+    replacements = []
+    lines = []
+    for key, value, keyvalue in edits:
+        key = bs(key)
+        value = bs(value)
+        if key.strip() in index:
+            replacements += index_replacements(data, index[key.strip()], value)
+        elif has_key(data, key) or assigns(data, key.strip()):
+            replacements += line_replacements(data, key, value)
+        elif fmt == "plain":
+            lines.append(bs(keyvalue))
+        else:
+            pos, text = addition(data, key, value, fmt, blocks)
+            if pos is not None:
+                replacements.append((pos, pos, text))
+            elif text is not None:
+                lines.append(text)
+    # Sort by start only, so that keys added at the same place keep their order
+    replacements.sort(key=lambda replacement: replacement[0])
+    return replacements, lines
+
+
+def change_or_add(data, key, value, keyvalue, fmt="plain"):
+    """Change the key in the data to the given value, or find where to add it.
+    keyvalue is the line that is added for the plain format.
+    Returns a list of segments for the new data, and a line to add at the end
+    of the data or None. The list is empty if nothing would be changed or if
+    there is a line to add."""
+    replacements, lines = plan_edits(data, [(key, value, keyvalue)], fmt)
+    if lines:
+        return [], lines[0]
+    return to_segments(data, replacements), None
+
+
+def changeoradd(filename, key, value, keyvalue, fmt="plain"):
+    """Change the key in the file to the given value, or add it if the key is
+    not there. keyvalue is the line that is added for the plain format.
+    The file is read once and only written to if something changes."""
+
+    key = bs(key)
+    value = bs(value)
+
     # Read the file
     try:
         with open(filename, 'rb') as f:
             data = f.read()
-            lines = data.split(NL)[:-1]
     except IOError:
         print("Can't read %s" % (filename))
         sysexit(2)
-    if data.strip() == bs(""):
-        lines = []
-    elif NL not in data:
-        lines = [data]
-    # Change and write the file
+    segments, line = change_or_add(data, key, value, keyvalue, fmt)
+    if line is not None:
+        # Only append to the file
+        addtofile(filename, line)
+        return
+    if not segments:
+        # The key is already there, with the same value
+        return
     try:
         with open(filename, 'wb') as f:
-            lines.append(line)
-            added_data = NL.join(lines) + NL
-            f.write(added_data)
+            write_segments(f, segments)
     except IOError:
         print("No write permission: %s" % (filename))
         sysexit(2)
@@ -267,13 +464,52 @@ def test_changefile():
     # Read the file
     with open(filename, 'rb') as f:
         newcontent = f.read().split(NL)[:-1]
+    # The last line has no newline
+    with open(filename, 'wb') as f:
+        f.write(bs("a=1") + NL + bs("b=2"))
+    changefile(filename, "b", "3")
+    with open(filename, 'rb') as f:
+        newcontent2 = f.read()
     # Do the tests
     passes = True
     passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
+    passes = passes and newcontent2 == bs("a=1") + NL + bs("b=3")
     print("Changefile passes: %s" % (passes))
     return passes
 
 
+def multiline_segments(data, key, value, endstring=NL, verbose=True, searchfrom=0):
+    """Change a value that may span several lines, like change_multiline.
+    Returns the new data as a list of segments, where the parts before and
+    after the value are slices of a memoryview of the data.
+    Returns an empty list if the key or end marker was not found.
+    The data, key, value and endstring must be bytes."""
+    if key not in data:
+        return []
+    if (endstring != NL) and (endstring not in data):
+        if verbose:
+            print("Multiline end marker not found: " + endstring.decode("utf-8", "replace"))
+        return []
+    startpos = data.find(key, searchfrom)
+    if endstring in data:
+        endpos = data.find(endstring, startpos + 1)
+    else:
+        endpos = len(data) - 1
+    linestartpos = data.rfind(NL, 0, startpos) + 1
+    # If the first part of the line is not a key (could be because it's commented out)...
+    if not firstpart(data[linestartpos:endpos + 1]):
+        # Search again, from endpos this time
+        return multiline_segments(data, key, value, endstring, verbose, endpos)
+    between = data[startpos:endpos + 1]
+    newbetween = changeline(between, value)
+    if between.endswith(CRLF):
+        newbetween += CRLF
+    elif between.endswith(NL):
+        newbetween += NL
+    data_view = view(data)
+    return [data_view[:startpos], newbetween, data_view[endpos + len(endstring):]]
+
+
 def change_multiline(data, key, value, endstring=NL, verbose=True, searchfrom=0):
 
     data = bs(data)
@@ -435,7 +671,7 @@ build() {
     return passes
 
 
-def changefile_multiline(filename, key, value, endstring=bs("\n")):
+def changefile_multiline(filename, key, value, endstring=NL):
 
     key = bs(key)
     value = bs(value)
@@ -448,10 +684,13 @@ def changefile_multiline(filename, key, value, endstring=bs("\n")):
         print("Can't read %s" % (filename))
         sysexit(2)
     # Change and write the file
-    new_contents = change_multiline(data, key, value, endstring)
+    segments = multiline_segments(data, key, value, endstring)
+    if not segments:
+        # Nothing to change
+        return
     try:
         with open(filename, 'wb') as f:
-            f.write(new_contents)
+            write_segments(f, segments)
     except:  # UnicodeEncodeError: not supported by shedskin
         #print("codeEncodeError: Can't change value for %s" % (filename))
         print("Can't change value for %s" % (filename))
@@ -526,6 +765,32 @@ def test_addline():
     return passes
 
 
+def test_append():
+    passes = True
+    filename = mkstemp()[1]
+    # A large file with CRLF line endings and no newline at the end
+    testcontent = (bs("x=1") + CRLF) * (TAIL_SIZE // 3) + bs("y=2")
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    addtofile(filename, "z=3")
+    main(["-a", filename, "w", "4"])
+    main(["-a", filename, "y", "5"])
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    testcontent_changed = (bs("x=1") + CRLF) * (TAIL_SIZE // 3) + bs("y=5") + CRLF + \
+        bs("z=3") + CRLF + bs("w=4") + CRLF
+    passes = passes and newcontent == testcontent_changed
+    # A file with only whitespace is replaced
+    with open(filename, 'wb') as f:
+        f.write(bs("  ") + NL)
+    addtofile(filename, "a=1")
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    passes = passes and newcontent == bs("a=1") + NL
+    print("Append passes: %s" % (passes))
+    return passes
+
+
 def test_latin1():
     # Test data
     testcontent = b64decode(
@@ -549,6 +814,388 @@ def test_latin1():
     return passes
 
 
+def test_newlines():
+    passes = True
+    # CRLF
+    testcontent = bs("a = 1\r\nb = 2\r\n")
+    testcontent_changed = bs("a = 1\r\nb = 4\r\nc=5\r\n")
+    filename = mkstemp()[1]
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    changefile(filename, "b", "3")
+    changefile_multiline(filename, "b", "4")
+    main(["-a", filename, "c", "5"])
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    passes = passes and newcontent == testcontent_changed
+    passes = passes and get_value(testcontent, bs("b")) == bs("2")
+    passes = passes and has_key(bs("a=1\r\nb=2\r\n"), bs("b"))
+    if not passes:
+        print("FAIL CRLF")
+    # Mixed line endings keep the line ending of each line
+    testcontent = bs("a=1\nb=2\r\nc=3\n")
+    testcontent_changed = bs("a=1\nb=9\r\nc=3\nd=4\n")
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    changefile(filename, "b", "9")
+    main(["-a", filename, "d=4"])
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    passes = passes and newcontent == testcontent_changed
+    passes = passes and detect_newline(testcontent) == NL
+    passes = passes and detect_newline(bs("a\r\nb\r\nc\n")) == CRLF
+    if not passes:
+        print("FAIL MIXED")
+    # Format backends
+    testcontent = bs("[one]\r\nx = 1\r\n")
+    testcontent_changed = bs("[one]\r\nx = 2\r\ny=3\r\n")
+    a = main_on_file(".ini", testcontent, [["one.x", "2"], ["-a", "one.y", "3"]])
+    passes = passes and a == testcontent_changed
+    if not passes:
+        print("FAIL INI CRLF")
+    print("Newlines passes: %s" % (passes))
+    return passes
+
+
+def main_on_file(suffix, testcontent, runs):
+    """Run main on a temporary file with the given suffix and contents,
+    once for each list of arguments, where the filename is added after
+    any "-a". Returns the new contents of the file."""
+    filename = mkstemp(suffix=suffix)[1]
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    for args in runs:
+        if args[0] == "-a":
+            main(["-a", filename] + args[1:])
+        else:
+            main([filename] + args)
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    remove(filename)
+    return newcontent
+
+
+def test_formats():
+    passes = True
+    # INI sections
+    testcontent = bs("a = 1\n[one]\nx = 1\n; x = 0\n[two]\nx =\t2   \n")
+    testcontent_changed = bs("a = 1\n[one]\nx = 1\n; x = 0\n[two]\nx =\t3   \n")
+    a = main_on_file(".ini", testcontent, [["two.x", "3"], ["three.x", "3"]])
+    passes = passes and a == testcontent_changed
+    testcontent_changed = bs("a = 1\nb=2\n[one]\nx = 1\ny=2\n; x = 0\n[two]\nx =\t2   \n[new]\nz=3\n")
+    a = main_on_file(".ini", testcontent, [["-a", "b", "2"], ["-a", "one.y", "2"],
+                                           ["-a", "new.z", "3"]])
+    passes = passes and a == testcontent_changed
+    if not passes:
+        print("FAIL INI")
+    # YAML
+    testcontent = bs("""server:
+  port: 80 # the port
+  host: "a: b"
+  tags:
+  - a
+name: 'it''s'
+""")
+    testcontent_changed = bs("""server:
+  port: 8080 # the port
+  host: "a: b"
+  tags: [b]
+  ssl:
+    cert: x.pem
+name: 'it''s'
+""")
+    a = main_on_file(".yml", testcontent, [["server.port", "8080"], ["server.tags", "[b]"],
+                                           ["-a", "server.ssl.cert", "x.pem"]])
+    passes = passes and a == testcontent_changed
+    passes = passes and get_value(testcontent, bs("server.host"), "yaml") == bs('"a: b"')
+    # Keys in list items are not indexed, and keys are not added to lists
+    for testcontent, key in [("items:\n  - name: a\n    port: 1\nother: 2\n", "items"),
+                             ("tags:\n- a\nx: 1\n", "tags")]:
+        filename = mkstemp(suffix=".yml")[1]
+        with open(filename, 'wb') as f:
+            f.write(bs(testcontent))
+        main([filename, key + ".port", "2"])
+        main(["-a", filename, key + ".foo", "3"])
+        with open(filename, 'rb') as f:
+            newcontent = f.read()
+        passes = passes and newcontent == bs(testcontent)
+    if not passes:
+        print("FAIL YAML")
+    # #define and (setq
+    testcontent = bs('#define A 1 // one\n#  define B "//"\n#define F(x) x\n#define E\n(setq c (list 1))\n')
+    testcontent_changed = bs('#define A 2 // one\n#  define B "/"\n#define F(x) x\n#define E 1\n(setq c nil)\n')
+    a = main_on_file(".h", testcontent, [["A", "2"], ["B", '"/"'], ["E", "1"], ["c", "nil"]])
+    passes = passes and a == testcontent_changed
+    a = main_on_file(".h", testcontent, [["F", "2"]])
+    passes = passes and a == testcontent
+    if not passes:
+        print("FAIL DEFINE")
+    # Multiline values with an end marker, in files where the format is detected
+    for suffix, testcontent, testcontent_changed, value in [
+            (".ini", "x=(a\nb)\ny=1\n", "x=(c d)\ny=1\n", "(c d)"),
+            (".h", "#define x (1 \\\n 2)\n#define y 1\n", "#define x (3)\n#define y 1\n", "(3)"),
+            (".yml", 'x: "a\n  b"\ny: 1\n', 'x: "c"\ny: 1\n', '"c"')]:
+        filename = mkstemp(suffix=suffix)[1]
+        with open(filename, 'wb') as f:
+            f.write(bs(testcontent))
+        main([filename, "x", value, value[-1]])
+        with open(filename, 'rb') as f:
+            newcontent = f.read()
+        passes = passes and newcontent == bs(testcontent_changed)
+    if not passes:
+        print("FAIL MULTILINE")
+    # Adding keys to files
+    filename = mkstemp(suffix=".h")[1]
+    with open(filename, 'wb') as f:
+        f.write(bs("#define A 1"))
+    main(["-a", filename, "B", "2"])
+    main(["-a", filename, "B", "2"])
+    main(["-a", filename, "A", "3"])
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    passes = passes and newcontent == bs("#define A 3\n#define B 2\n")
+    filename = mkstemp(suffix=".yml")[1]
+    with open(filename, 'wb') as f:
+        f.write(bs("a:\n  b: 1\n"))
+    main(["-a", filename, "a.c", "2"])
+    main(["-a", filename, "d", "3"])
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    passes = passes and newcontent == bs("a:\n  b: 1\n  c: 2\nd: 3\n")
+    if not passes:
+        print("FAIL ADD")
+    print("Formats passes: %s" % (passes))
+    return passes
+
+
+def test_watch():
+    passes = True
+    edits = [(bs("x"), bs("1")), (bs("y"), bs("2"))]
+    passes = passes and enforce(bs("x=1\ny = 3\n"), edits) == bs("x=1\ny = 2\n")
+    passes = passes and enforce(bs("x=1\ny = 2\n"), edits) is None
+    passes = passes and enforce(bs("x=1\r\n"), edits) == bs("x=1\r\ny=2\r\n")
+    passes = passes and enforce(bs("[a]\nx=1\n"), [(bs("a.y"), bs("2"))], "ini") == \
+        bs("[a]\nx=1\ny=2\n")
+    # Several edits with the same index
+    edits2 = [(bs("a.x"), bs("2")), (bs("a.y"), bs("3")), (bs("a.z"), bs("4")), (bs("w"), bs("5"))]
+    passes = passes and enforce(bs("w=0\n[a]\nx=1\n[b]\n"), edits2, "ini") == \
+        bs("w=5\n[a]\nx=2\ny=3\nz=4\n[b]\n")
+    # The directory is watched, so use a directory that nothing else changes
+    directory = mkdtemp()
+    filename = join(directory, "watched.conf")
+    with open(filename, 'wb') as f:
+        f.write(bs("x=0\ny=0\n"))
+    passes = passes and enforcefile(filename, edits)
+    passes = passes and not enforcefile(filename, edits)
+
+    # Another program changes the file while it is being watched,
+    # and removes one of the keys
+    def drift():
+        with open(filename, 'wb') as f:
+            f.write(bs("x=5\nz=3\n"))
+    timer = Timer(0.05, drift)
+    timer.start()
+    watch(filename, edits, interval=0.05, timeout=1.0)
+    timer.join()
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    passes = passes and newcontent == bs("x=1\nz=3\ny=2\n")
+    remove(filename)
+    rmdir(directory)
+    print("Watch passes: %s" % (passes))
+    return passes
+
+
+# Differential tests
+#
+# The functions below are the line based implementations from setconf 0.7.1.
+# They are kept as references, to check that the faster functions that are
+# used for changing files give the same results on generated data.
+
+
+def reference_parts(line, including_assignment=True):
+    """The parts function from setconf 0.7.1"""
+    stripline = line.strip()
+    if not stripline:
+        return None, None
+    # Skip lines that start with #, // or /*
+    for commentsymbol in [bs("#"), bs("//"), bs("/*")]:
+        if stripline.startswith(commentsymbol):
+            # Skip this line
+            return None, None
+    # These assignments are supported, in this order
+    assignment = bs("")
+    found = []
+    for ass in ASSIGNMENTS:
+        # Skip the += and -= operators when finding keys and values
+        if ass in [bs('+='), bs('-=')]:
+            continue
+        # Collect the rest
+        if ass in line:
+            found.append(ass)
+    if len(found) == 1:
+        # Only one assignment were found
+        assignment = found[0]
+    elif found:  # > 1
+        # If several assignments are found, use the first one
+        firstpos = len(line)
+        firstassignment = bs("")
+        for ass in found:
+            pos = line.index(ass)
+            if pos < firstpos:
+                firstpos = pos
+                firstassignment = ass
+        assignment = firstassignment
+    # Return the "key" part of the line
+    if assignment:
+        fields = line.split(assignment, 1)
+        if including_assignment:
+            return fields[0] + assignment, fields[1]
+        else:
+            return fields[0], fields[1]
+    # No assignments were found
+    return None, None
+
+
+def reference_changeline(line, newvalue):
+    """The changeline function from setconf 0.7.1"""
+    line = bs(line)
+    newvalue = bs(newvalue)
+
+    first = reference_parts(line)[0]
+    if first:
+        if bs("= ") in line or bs(": ") in line or bs("> ") in line:
+            return first + bs(" ") + newvalue
+        elif bs("=\t") in line or bs(":\t") in line or bs(">\t") in line:
+            return first + bs("\t") + newvalue
+        else:
+            return first + newvalue
+    else:
+        return line
+
+
+def reference_change(lines, key, value):
+    """The change function from setconf 0.7.1"""
+    newlines = []
+    for line in lines:
+        if not line.strip():
+            newlines.append(line)
+            continue
+        firstp = reference_parts(line, False)[0]
+        if not firstp:
+            newlines.append(line)
+            continue
+        elif firstp.strip() == key:
+            newlines.append(reference_changeline(line, value))
+        else:
+            newlines.append(line)
+    return newlines
+
+
+DIFF_KEYS = ["x", "CC", "pkgrel", "TMPROOT", "ost", "md5sums", "æøå", "a b", "x.y"]
+DIFF_ASSIGNMENTS = ["==", "=>", "+=", "-=", "?=", "=", ":=", "::", ":"]
+DIFF_SPACES = ["", " ", "\t", "  ", " \t"]
+DIFF_VALUES = ["1", "2", "${TMPDIR:=/tmp}", "g++", "(a b)", "'x'", "http://a/b", "a = b",
+               "ÆØÅ", "", "[1, 2, 3]", "x == y", "// ost = 2", "# not a comment"]
+DIFF_PREFIXES = ["", "", "", "  ", "    ", "\t", "# ", "// ", "/* ", "export "]
+DIFF_ENDSTRINGS = ["\n", ")", "]", "'", "CHEESE"]
+
+
+def generate_line(rnd):
+    """Return a random line that looks like a line from a configuration file"""
+    kind = rnd.random()
+    if kind < 0.1:
+        return bs(rnd.choice(["", " ", "\t"]))
+    if kind < 0.2:
+        return bs(rnd.choice(["build() {", "}", "CHEESE", "[section]", "blabla", ")"]))
+    value = rnd.choice(DIFF_VALUES)
+    if kind < 0.3:
+        # A value that spans several lines
+        value = "(" + "\n".join(rnd.choice(DIFF_VALUES) for i in range(rnd.randint(1, 3))) + ")"
+    line = (rnd.choice(DIFF_PREFIXES) + rnd.choice(DIFF_KEYS) + rnd.choice(DIFF_SPACES) +
+            rnd.choice(DIFF_ASSIGNMENTS) + rnd.choice(DIFF_SPACES) + value)
+    line = bs(line)
+    if rnd.random() < 0.05:
+        # ISO-8859-1 encoded text
+        line += bytes(bytearray([0xe5, 0xe6, 0xf8]))
+    return line
+
+
+def generate_data(rnd, count):
+    """Return random configuration file data, with count lines"""
+    data = NL.join([generate_line(rnd) for i in range(count)])
+    if rnd.random() < 0.8:
+        data += NL
+    return data
+
+
+def outcome(function, *args):
+    """Return the result of the function, or the type of the raised exception"""
+    try:
+        return function(*args)
+    except Exception:
+        return sys_exc_info()[0]
+
+
+def differences(data, key, value, endstring):
+    """Compare the faster functions with the reference functions for the given
+    data and return a list of the names of the functions that differ."""
+    names = []
+    for line in data.split(NL):
+        if parts(line) != reference_parts(line) or \
+                parts(line, False) != reference_parts(line, False):
+            names.append("parts")
+            break
+    # change
+    expected = NL.join(reference_change(data.split(NL), key, value))
+    segments = change_segments(data, key, value)
+    if (bs("").join(segments) if segments else data) != expected:
+        names.append("change_segments")
+    # The same, with CRLF line endings
+    crlfdata = data.replace(NL, CRLF)
+    segments = change_segments(crlfdata, key, value)
+    if (bs("").join(segments) if segments else crlfdata) != expected.replace(NL, CRLF):
+        names.append("change_segments with CRLF")
+    # change_multiline
+    expected = outcome(change_multiline, data, key, value, endstring, False)
+    segments = outcome(multiline_segments, data, key, value, endstring, False)
+    if type(segments) == type([]):
+        segments = bs("").join(segments) if segments else data
+    if segments != expected:
+        names.append("multiline_segments")
+    return names
+
+
+def test_differential(seed=0, rounds=300):
+    rnd = Random(seed)
+    passes = True
+    # Many small files and one large file
+    sizes = [rnd.randint(0, 30) for i in range(rounds)] + [20000]
+    # The files from the testcases directory, if available
+    corpus = []
+    testcases = join(dirname(abspath(__file__)), "testcases")
+    if exists(testcases):
+        for name in sorted(listdir(testcases)):
+            if name.endswith(".orig"):
+                with open(join(testcases, name), 'rb') as f:
+                    corpus.append(f.read())
+    for size in sizes + [None] * len(corpus):
+        if size is None:
+            data = corpus.pop()
+        else:
+            data = generate_data(rnd, size)
+        key = bs(rnd.choice(DIFF_KEYS))
+        value = bs(rnd.choice(DIFF_VALUES))
+        endstring = bs(rnd.choice(DIFF_ENDSTRINGS))
+        names = differences(data, key, value, endstring)
+        if names:
+            print("FAIL %s: %r %r %r %r" % (", ".join(names), data[:200], key, value, endstring))
+            passes = False
+            break
+    print("Differential passes: %s" % (passes))
+    return passes
+
+
 def tests():
     # If one test fails, the rest will not be run
     passes = True
@@ -559,6 +1206,11 @@ def tests():
     passes = passes and test_changefile_multiline()
     passes = passes and test_addline()
     passes = passes and test_latin1()
+    passes = passes and test_append()
+    passes = passes and test_formats()
+    passes = passes and test_newlines()
+    passes = passes and test_watch()
+    passes = passes and test_differential()
     if passes:
         print("All tests pass!")
     else:
@@ -576,8 +1228,8 @@ def create_if_missing(filename):
 
 def has_key(data, key):
     """Check if the given key exists in the given data."""
-    lines = data.split(NL)[:-1]
-    for line in lines:
+    for start, end in key_lines(data, key):
+        line = data[start:end]
         if not line.strip():
             # Skip blank lines
             continue
@@ -587,10 +1239,15 @@ def has_key(data, key):
     return False
 
 
-def get_value(data, key):
+def get_value(data, key, fmt="plain"):
     """Return the first value for a given key."""
-    lines = data.split(NL)[:-1]
-    for line in lines:
+    if fmt != "plain":
+        index = FORMATS[fmt][0](data)[0]
+        if key.strip() in index:
+            start, end, _ = index[key.strip()][0]
+            return data[start:end].strip()
+    for start, end in key_lines(data, key):
+        line = data[start:end]
         if not line.strip():
             # Skip blank lines
             continue
@@ -604,6 +1261,526 @@ def get_value(data, key):
     return bs("")
 
 
+# Format backends
+#
+# Each backend indexes the keys of a file in a single pass. The index maps
+# a key to a list of [start, end, prefix] spans, where start and end are
+# the positions of the value in the data and prefix is placed in front of
+# a new value if there is no space before start. Only the
+# bytes between start and end are replaced, everything else is kept as it is.
+
+FORMAT_EXTENSIONS = {".ini": "ini", ".yml": "yaml", ".yaml": "yaml",
+                     ".h": "define", ".hh": "define", ".hpp": "define",
+                     ".el": "define"}
+
+
+def detect_format(filename):
+    """Guess the format of a file from the extension of the filename"""
+    return FORMAT_EXTENSIONS.get(splitext(filename)[1].lower(), "plain")
+
+
+def line_spans(data):
+    """Return the start and end position of each line, without the newline"""
+    spans = []
+    pos = 0
+    length = len(data)
+    while pos < length:
+        end = data.find(NL, pos)
+        if end == -1:
+            end = length
+        nextpos = end + 1
+        if end > pos and data[end - 1:end] == CR:
+            end -= 1
+        spans.append((pos, end))
+        pos = nextpos
+    return spans
+
+
+def skip_space(data, pos, end):
+    """Return the first position from pos that is not a space or a tab"""
+    while pos < end and data[pos:pos + 1] in [bs(" "), bs("\t")]:
+        pos += 1
+    return pos
+
+
+def find_space(data, pos, end):
+    """Return the first position from pos that is a space or a tab, or end"""
+    while pos < end and data[pos:pos + 1] not in [bs(" "), bs("\t")]:
+        pos += 1
+    return pos
+
+
+def closing_quote(data, pos, end):
+    """Return the position after the quoted string that starts at pos,
+    or -1 if the string is not closed before end."""
+    quote = data[pos:pos + 1]
+    i = pos + 1
+    while i < end:
+        c = data[i:i + 1]
+        if c == bs("\\") and quote == bs('"'):
+            i += 2
+            continue
+        if c == quote:
+            if quote == bs("'") and data[i + 1:i + 2] == quote:
+                # '' is an escaped ' in YAML
+                i += 2
+                continue
+            return i + 1
+        i += 1
+    return -1
+
+
+def index_ini(data):
+    """Index the keys in INI data. Keys in a section are found both as
+    "section.key" and as "key". The blocks map each section to the end of
+    its last line, where new keys can be added. Keys that come before the
+    first section are in the "" section. None maps to the position of the
+    first section header."""
+    index = {}
+    blocks = {}
+    section = bs("")
+    for start, end in line_spans(data):
+        line = data[start:end]
+        stripline = line.strip()
+        if not stripline or stripline[:1] in [bs("#"), bs(";")]:
+            continue
+        if stripline.startswith(bs("[")) and bs("]") in stripline:
+            section = stripline[1:stripline.index(bs("]"))].strip()
+            if None not in blocks:
+                blocks[None] = start
+            blocks[section] = end
+            continue
+        blocks[section] = end
+        first, second = parts(line, False)
+        if first is None:
+            continue
+        valstart = skip_space(data, end - len(second), end)
+        valend = max(valstart, start + len(line.rstrip()))
+        key = first.strip()
+        span = [valstart, valend, bs("")]
+        if section:
+            index.setdefault(section + bs(".") + key, []).append(span)
+        index.setdefault(key, []).append(span)
+    return index, blocks
+
+
+def add_ini(data, key, value, blocks):
+    """Find where to add a key to INI data. The section is the
+    longest part of the key, before a ".", that is an existing section.
+    If there is none, a new section is added after the other ones.
+    Returns the position and the bytes to insert there, see addition."""
+    section, name = bs(""), key
+    pos = key.find(bs("."))
+    while pos != -1:
+        if key[:pos] in blocks:
+            section, name = key[:pos], key[pos + 1:]
+        pos = key.find(bs("."), pos + 1)
+    if not section and bs(".") in key and key not in blocks:
+        section, name = key.split(bs("."), 1)
+    line = name + bs("=") + value
+    newline = detect_newline(data)
+    if section in blocks:
+        return blocks[section], newline + line
+    if section:
+        return None, bs("[") + section + bs("]") + newline + line
+    if None in blocks:
+        # Add the key before the first section
+        return blocks[None], line + newline
+    return None, line
+
+
+def index_yaml(data):
+    """Index the keys in YAML data, as "parent.child" paths. The value of
+    a key includes the lines that are indented more than the key.
+    The blocks map each key without a value on the same line to the end
+    of its last line, the indentation of its children (or None), the
+    indentation of the key itself and if the children are list items.
+    Keys inside list items are not indexed."""
+    index = {}
+    blocks = {}
+    # [indentation, path, span, is a block], the path is None for list items
+    # and for everything inside them
+    stack = []
+    for start, end in line_spans(data):
+        line = data[start:end]
+        stripline = line.lstrip(bs(" "))
+        if not stripline.strip() or stripline.startswith(bs("#")):
+            continue
+        if stripline.startswith(bs("---")) or stripline.startswith(bs("...")):
+            # A new document
+            stack = []
+            continue
+        indent = len(line) - len(stripline)
+        item = stripline[:1] == bs("-") and stripline[1:2] in [bs(""), bs(" ")]
+        # Leave the keys that this line does not belong to
+        while stack and (stack[-1][0] > indent or (stack[-1][0] == indent and
+                                                   not (item and stack[-1][3]))):
+            stack.pop()
+        if stack and stack[-1][3] and blocks[stack[-1][1]][1] is None:
+            # The first line below a block gives the indentation of the children
+            blocks[stack[-1][1]][1] = indent
+            blocks[stack[-1][1]][3] = item
+        for entry in stack:
+            if entry[1] is None:
+                continue
+            entry[2][1] = end
+            if entry[3]:
+                blocks[entry[1]][0] = end
+        if item:
+            stack.append([indent, None, None, False])
+            continue
+        if stack and stack[-1][1] is None:
+            # A key inside a list item
+            stack.append([indent, None, None, False])
+            continue
+        # Find the key
+        keystart = start + indent
+        if stripline[:1] in [bs('"'), bs("'")]:
+            keyend = closing_quote(data, keystart, end)
+            if keyend == -1:
+                continue
+            name = data[keystart + 1:keyend - 1]
+        else:
+            keyend = data.find(bs(":"), keystart, end)
+            while keyend != -1 and data[keyend + 1:keyend + 2] not in [bs(""), bs(" "), CR, NL]:
+                keyend = data.find(bs(":"), keyend + 1, end)
+            if keyend == -1:
+                continue
+            name = data[keystart:keyend].rstrip()
+        colon = skip_space(data, keyend, end)
+        if data[colon:colon + 1] != bs(":"):
+            continue
+        if stack:
+            path = stack[-1][1] + bs(".") + name
+        else:
+            path = name
+        # Find the value on the same line
+        valstart = skip_space(data, colon + 1, end)
+        c = data[valstart:valstart + 1]
+        block = False
+        if valstart == end or c == bs("#"):
+            valstart = valend = colon + 1
+            block = True
+        elif c in [bs('"'), bs("'")]:
+            valend = closing_quote(data, valstart, end)
+            if valend == -1:
+                valend = end
+        else:
+            valend = data.find(bs(" #"), valstart, end)
+            if valend == -1:
+                valend = end
+            valend = valstart + len(data[valstart:valend].rstrip())
+        span = [valstart, valend, bs(" ")]
+        index.setdefault(path, []).append(span)
+        if block:
+            blocks[path] = [end, None, indent, False]
+        stack.append([indent, path, span, block])
+    return index, blocks
+
+
+def add_yaml(data, key, value, blocks):
+    """Find where to add a key to YAML data, below the deepest parent that
+    exists. Returns the position and the bytes to insert there, see addition,
+    or None, None if the parent is a list."""
+    names = key.split(bs("."))
+    depth = len(names) - 1
+    while depth > 0 and bs(".").join(names[:depth]) not in blocks:
+        depth -= 1
+    indent = 0
+    if depth:
+        pos, indent, parentindent, items = blocks[bs(".").join(names[:depth])]
+        if items:
+            print("Can't add %s to a list" % (key.decode("utf-8", "replace")))
+            return None, None
+        if indent is None:
+            indent = parentindent + 2
+    lines = []
+    for name in names[depth:-1]:
+        lines.append(bs(" ") * indent + name + bs(":"))
+        indent += 2
+    lines.append(bs(" ") * indent + names[-1] + bs(": ") + value)
+    newline = detect_newline(data)
+    if depth:
+        return pos, newline + newline.join(lines)
+    return None, newline.join(lines)
+
+
+def index_define(data):
+    """Index the keys in lines like "#define KEY value" and "(setq key value)".
+    The value of a #define includes the lines after a line that ends with \\.
+    Macros with arguments are skipped."""
+    index = {}
+    spans = line_spans(data)
+    i = 0
+    while i < len(spans):
+        start, end = spans[i]
+        i += 1
+        pos = skip_space(data, start, end)
+        if data[pos:pos + 1] == bs("#"):
+            pos = skip_space(data, pos + 1, end)
+            if data[pos:pos + 6] != bs("define"):
+                continue
+            setq = False
+            pos += 6
+        elif data[pos:pos + 5] == bs("(setq"):
+            setq = True
+            pos += 5
+        else:
+            continue
+        keystart = skip_space(data, pos, end)
+        if keystart == pos:
+            continue
+        keyend = find_space(data, keystart, end)
+        if setq:
+            paren = data.find(bs(")"), keystart, keyend)
+            if paren != -1:
+                keyend = paren
+        key = data[keystart:keyend]
+        if not key or bs("(") in key:
+            continue
+        valstart = skip_space(data, keyend, end)
+        if setq:
+            # Find the parenthesis that closes (setq
+            depth = 1
+            valend = valstart
+            while valend < end:
+                c = data[valend:valend + 1]
+                if c in [bs('"')]:
+                    valend = closing_quote(data, valend, end)
+                    if valend == -1:
+                        break
+                    continue
+                if c == bs("("):
+                    depth += 1
+                elif c == bs(")"):
+                    depth -= 1
+                    if depth == 0:
+                        break
+                valend += 1
+            if valend in [-1, end]:
+                continue
+        else:
+            commentfrom = valstart
+            if data[valstart:valstart + 1] == bs('"'):
+                commentfrom = max(closing_quote(data, valstart, end), valstart)
+            valend = end
+            # Continue on the next line after a \\ at the end of a line
+            while data[start:valend].rstrip().endswith(bs("\\")) and i < len(spans):
+                start, valend = spans[i]
+                commentfrom = max(commentfrom, start)
+                i += 1
+            for comment in [bs("//"), bs("/*")]:
+                pos = data.find(comment, commentfrom, valend)
+                if pos != -1:
+                    valend = pos
+        valend = valstart + len(data[valstart:valend].rstrip())
+        if valstart == valend:
+            valstart = valend = keyend
+        index.setdefault(key, []).append([valstart, valend, bs(" ")])
+    return index, {}
+
+
+def add_define(data, key, value, blocks):
+    """Add a #define at the end, or a (setq if the data already uses that instead.
+    Returns the position and the bytes to insert there, see addition."""
+    if bs("(setq") in data and bs("#define") not in data:
+        return None, bs("(setq ") + key + bs(" ") + value + bs(")")
+    return None, bs("#define ") + key + bs(" ") + value
+
+
+FORMATS = {"ini": (index_ini, add_ini),
+           "yaml": (index_yaml, add_yaml),
+           "define": (index_define, add_define)}
+
+
+def indexed_segments(data, key, value, fmt, index=None):
+    """Change the value of all occurrences of the key, using the given
+    format backend, or the index from it if already made. Returns the new
+    data as a list of segments, which is empty if nothing would be changed,
+    or None if the key was not found."""
+    key = bs(key).strip()
+    value = bs(value)
+    if index is None:
+        index = FORMATS[fmt][0](data)[0]
+    if key not in index:
+        return None
+    return to_segments(data, index_replacements(data, index[key], value))
+
+
+def index_replacements(data, spans, value):
+    """Return a (start, end, new value) replacement for each of the spans
+    of a key from an index, that does not have the value"""
+    replacements = []
+    for start, end, prefix in spans:
+        if data[start - 1:start] in [bs(" "), bs("\t")]:
+            prefix = bs("")
+        if prefix + value != data[start:end]:
+            replacements.append((start, end, prefix + value))
+    return replacements
+
+
+def changed_segments(data, key, value, fmt="plain"):
+    """Change the value of the key with the format backend, or line by line
+    if the format is "plain" or the backend can not find the key.
+    Returns a list of segments, which is empty if nothing would be changed."""
+    segments = None
+    if fmt != "plain":
+        segments = indexed_segments(data, key, value, fmt)
+    if segments is None:
+        segments = change_segments(data, key, value)
+    return segments
+
+
+def ends_with_marker(data, key, endstring, fmt):
+    """Check if the format backend finds the key, and if each value it found
+    runs up to the first end marker after the start of the value. Only then
+    can the backend be used instead of changing a multiline value."""
+    spans = FORMATS[fmt][0](data)[0].get(bs(key).strip())
+    if not spans:
+        return False
+    for start, end, _ in spans:
+        if data.find(endstring, start + 1, end) != end - len(endstring):
+            return False
+    return True
+
+
+def addition(data, key, value, fmt="plain", blocks=None):
+    """Find where to add a key that is not in the data, using the given
+    format backend, or the blocks from it if already made.
+    Returns the position and the bytes to insert there. The position is
+    None if the bytes are lines for the end of the data."""
+    if fmt == "plain":
+        return None, bs(key).strip() + bs("=") + bs(value).strip()
+    if blocks is None:
+        blocks = FORMATS[fmt][0](data)[1]
+    return FORMATS[fmt][1](data, bs(key).strip(), bs(value).strip(), blocks)
+
+
+# Watch mode
+#
+# The file is checked again when inotify (Linux) reports a change in the
+# directory of the file, or at every interval if inotify is not available.
+# The file is only written when one of the keys does not have the desired value.
+
+IN_NONBLOCK = 0x800
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+
+def inotify_fd(filename):
+    """Return an inotify file descriptor that is readable when something in the
+    directory of the file changes, or None if inotify is not available.
+    The directory is watched since many tools replace files by renaming."""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK)
+    except (ImportError, OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    directory = bs(dirname(abspath(filename)))
+    if libc.inotify_add_watch(fd, ctypes.c_char_p(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def filestate(filename):
+    """Return what is needed to tell if a file has changed, or None if it is missing"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def enforce_segments(data, edits, fmt="plain"):
+    """Give the keys in the data the desired values, and add the keys that
+    are missing. edits is a list of (key, value) pairs. The data is indexed
+    once and all the changes are made in one go. Returns the new data as a
+    list of segments, which is empty if all keys had the desired values."""
+    replacements, lines = plan_edits(data, [(key, value, bs(key) + bs("=") + bs(value))
+                                            for key, value in edits], fmt)
+    if lines:
+        newline = detect_newline(data)
+        text = newline.join(lines) + newline
+        if data and not data.endswith(NL):
+            text = newline + text
+        replacements.append((len(data), len(data), text))
+    return to_segments(data, replacements)
+
+
+def enforce(data, edits, fmt="plain"):
+    """Give the keys in the data the desired values, like enforce_segments.
+    Returns the new data, or None if all keys already had the desired values."""
+    segments = enforce_segments(data, edits, fmt)
+    if not segments:
+        return None
+    return bs("").join(segments)
+
+
+def enforcefile(filename, edits, fmt="plain"):
+    """Read the file and write it if any of the keys have drifted from
+    the desired values. Returns True if the file was written."""
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except IOError:
+        # The file may be in the middle of being replaced
+        return False
+    segments = enforce_segments(data, edits, fmt)
+    if not segments:
+        return False
+    try:
+        with open(filename, 'wb') as f:
+            write_segments(f, segments)
+    except IOError:
+        print("No write permission: %s" % (filename))
+        return False
+    return True
+
+
+def watch(filename, edits, fmt="plain", interval=1.0, timeout=None):
+    """Keep the keys in the file at the desired values, until interrupted.
+    timeout is the number of seconds to watch the file before returning, or None."""
+    enforcefile(filename, edits, fmt)
+    laststate = filestate(filename)
+    fd = inotify_fd(filename)
+    deadline = None
+    if timeout is not None:
+        deadline = time() + timeout
+    try:
+        while deadline is None or time() < deadline:
+            wait = interval
+            if deadline is not None:
+                wait = max(0, min(interval, deadline - time()))
+            if fd is None:
+                sleep(wait)
+            elif select([fd], [], [], wait)[0]:
+                try:
+                    # Only the fact that something changed is needed
+                    os.read(fd, 65536)
+                except OSError:
+                    pass
+            state = filestate(filename)
+            if state is None or state == laststate:
+                continue
+            enforcefile(filename, edits, fmt)
+            laststate = filestate(filename)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
 def strip_trailing_zeros(s):
     return s.rstrip(bs('0')).rstrip(bs('.')) if bs('.') in s else s
 
@@ -635,6 +1812,31 @@ def dec(startvalue, s):
 
 
 def main(args=argv[1:], exitok=True):
+    # The format can be given with --format anywhere in the arguments
+    fmt = None
+    if "--format" in args:
+        pos = args.index("--format")
+        if pos + 1 == len(args):
+            sysexit(1)
+        fmt = args[pos + 1]
+        if fmt != "plain" and fmt not in FORMATS:
+            print("Unknown format: %s" % (fmt))
+            sysexit(2)
+        args = args[:pos] + args[pos + 2:]
+    if args and args[0] == "--watch":
+        # Watch mode: "setconf --watch filename x=1 y=2"
+        if len(args) < 3:
+            sysexit(1)
+        filename = args[1]
+        edits = []
+        for keyvalue in args[2:]:
+            keyvalue = bs(keyvalue)
+            if bs("=") not in keyvalue:
+                sysexit(2)
+            key, value = keyvalue.split(bs("="), 1)
+            edits.append((key, value))
+        watch(filename, edits, fmt or detect_format(filename))
+        return
     if len(args) == 1:
         if args[0] in ["-t", "--test"]:
             tests()
@@ -652,6 +1854,10 @@ def main(args=argv[1:], exitok=True):
             print("\t-v or --version\t\tversion number")
             print("\t-a or --add\t\tadd the option if it doesn't exist")
             print("\t\t\t\tcreates the file if needed")
+            print("\t--format FORMAT\t\tplain, ini, yaml or define")
+            print("\t\t\t\tdetected from the file extension if not given")
+            print("\t--watch\t\t\tkeep running and set the keys again")
+            print("\t\t\t\twhen the file is changed")
             #print("\t-r or --remove\t\tremove the option if it exist")
             print("")
             print("Examples:")
@@ -661,6 +1867,9 @@ def main(args=argv[1:], exitok=True):
             print("\tsetconf PKGBUILD sha256sums \"('123abc' 'abc123')\" ')'")
             print("\tsetconf app.py NUMS \"[1, 2, 3]\" ']'")
             print("\tsetconf -a server.conf ABC 123")
+            print("\tsetconf --format ini php.ini Session.gc_maxlifetime 3600")
+            print("\tsetconf config.yml server.port 8080")
+            print("\tsetconf --watch my.conf x=42 y=7")
             #print("\tsetconf -r server.conf ABC")
             print("")
         elif args[0] in ["-v", "--version"]:
@@ -669,6 +1878,7 @@ def main(args=argv[1:], exitok=True):
         # Single line replace: "x=123" or "x+=2"
         filename = args[0]
         keyvalue = bs(args[1])
+        fmt = fmt or detect_format(filename)
         if bs("+=") in keyvalue:
             key, value = keyvalue.split(bs("+="), 1)
             try:
@@ -677,8 +1887,8 @@ def main(args=argv[1:], exitok=True):
             except IOError:
                 print("Can't read %s" % (filename))
                 sysexit(2)
-            datavalue = get_value(data, key)
-            changefile(filename, key, inc(datavalue, value))
+            datavalue = get_value(data, key, fmt)
+            changefile(filename, key, inc(datavalue, value), fmt=fmt)
         elif bs("-=") in keyvalue:
             key, value = keyvalue.split(bs("-="), 1)
             try:
@@ -687,11 +1897,11 @@ def main(args=argv[1:], exitok=True):
             except IOError:
                 print("Can't read %s" % (filename))
                 sysexit(2)
-            datavalue = get_value(data, key)
-            changefile(filename, key, dec(datavalue, value))
+            datavalue = get_value(data, key, fmt)
+            changefile(filename, key, dec(datavalue, value), fmt=fmt)
         elif bs("=") in keyvalue:
             key, value = keyvalue.split(bs("="), 1)
-            changefile(filename, key, value)
+            changefile(filename, key, value, fmt=fmt)
         else:
             sysexit(2)
     elif len(args) == 3:
@@ -699,6 +1909,7 @@ def main(args=argv[1:], exitok=True):
             # Single line replace/add ("x 123")
             filename = args[1]
             keyvalue = bs(args[2])
+            fmt = fmt or detect_format(filename)
 
             create_if_missing(filename)
 
@@ -714,43 +1925,40 @@ def main(args=argv[1:], exitok=True):
             _, value = keyvalue.split(assignment, 1)
             key = firstpart(keyvalue, False)
 
-            if changefile(filename, key, value, dummyrun=True):
-                changefile(filename, key, value)
-            else:
-                with open(filename, 'rb') as f:
-                    data = f.read()
-                if not has_key(data, key):
-                    addtofile(filename, keyvalue)
+            changeoradd(filename, key, value, keyvalue, fmt)
         else:
             # Single line replace ("x 123")
             filename = args[0]
             key = bs(args[1])
             value = bs(args[2])
-            changefile(filename, key, value)
+            changefile(filename, key, value, fmt=fmt or detect_format(filename))
     elif len(args) == 4:
         if args[0] in ["-a", "--add"]:
             filename = args[1]
             key = bs(args[2])
             value = bs(args[3])
+            fmt = fmt or detect_format(filename)
 
             create_if_missing(filename)
 
             # Change the file if possible, if not, add the key value
-            if changefile(filename, key, value, dummyrun=True):
-                changefile(filename, key, value)
-            else:
-                keyvalue = key + bs("=") + value
-                with open(filename, 'rb') as f:
-                    data = f.read()
-                if not has_key(data, key):
-                    addtofile(filename, keyvalue)
+            changeoradd(filename, key, value, key + bs("=") + value, fmt)
         else:
             # Multiline replace
             filename = args[0]
             key = bs(args[1])
             value = bs(args[2])
             endstring = bs(args[3])
-            changefile_multiline(filename, key, value, endstring)
+            fmt = fmt or detect_format(filename)
+            indexed = False
+            if fmt != "plain" and exists(filename):
+                with open(filename, 'rb') as f:
+                    indexed = ends_with_marker(f.read(), key, endstring, fmt)
+            if indexed:
+                # The format backend found values that end with the end marker
+                changefile(filename, key, value, fmt=fmt)
+            else:
+                changefile_multiline(filename, key, value, endstring)
     else:
         sysexit(1)
 